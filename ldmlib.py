@@ -18,18 +18,24 @@ permissions and limitations under the License.
 '''
 
 import math
+import time
 import struct
+import logging
+import operator
 import datetime
+from multiprocessing import shared_memory, resource_tracker
 
 datetime_2004 = datetime.datetime(year=2004, month=1, day=1)
+
+# beginning of 2004 in seconds since the unix epoch
+_epoch_2004 = (datetime_2004 - datetime.datetime(year=1970, month=1, day=1)).total_seconds()
+
 def timestampits_now():
     '''return the current ITS timestamp, i.e., the number of milliseconds
     since the beginning of 2004.
 
     '''
-    return round(
-        (datetime.datetime.now() - datetime_2004).total_seconds() * 1000
-    )
+    return int((time.time() - _epoch_2004) * 1000)
 
 def gdt_now(timestampits):
     '''convert an ITS timestamp into generation delta time.'''
@@ -49,6 +55,52 @@ def timestampits_from_gdt(gdt):
     ts += gdt
     return ts
 
+def _query_args(position, max_distance, max_age):
+    '''validate the filtering arguments of iter_cams and replace omitted
+    ones with values that disable the corresponding filter. returns
+    the tuple (longitude, latitude, max_distance, max_age).
+
+    '''
+    if max_distance is None:
+        max_distance = math.inf
+    elif position is None:
+        raise ValueError('position must be given if max_distance is.')
+    if position is None:
+        position = (0.0, 0.0)
+        max_distance = math.inf
+    if max_age is None:
+        max_age = math.inf
+    longitude, latitude = position
+    return longitude, latitude, max_distance, max_age
+
+def _filter_rows(rows, longitude, latitude, max_distance, max_age):
+    '''return an iterator over the items of rows, an iterable of (item,
+    longitude, latitude, timestampits) tuples, that are within
+    max_distance of the given position and at most max_age old.
+
+    '''
+    # hoist everything that doesn't depend on the vehicle out of the
+    # loop: compare timestamps against a precomputed cutoff rather than
+    # computing each age, and compare squared distances to avoid a sqrt
+    # per vehicle.
+    min_timestampits = timestampits_now() - max_age
+    max_distance_sq = max_distance * max_distance
+    if max_distance == math.inf:
+        for item, lon, lat, ts in rows:
+            if ts < min_timestampits:
+                continue
+            yield item
+        return
+    for item, lon, lat, ts in rows:
+        if ts < min_timestampits:
+            continue
+        dx = lon - longitude
+        dy = lat - latitude
+        if dx*dx + dy*dy > max_distance_sq:
+            continue
+        yield item
+    return
+
 class CAM(object):
     '''ETSI ITS-G5 Cooperative awareness message (CAM).
 
@@ -116,27 +168,77 @@ class CAM(object):
     # packed bytes representation of a CAM message
     bytes_format = '!biibiiiiiiiiiiiiiiiiii'
 
+    # compiled once; avoids re-parsing bytes_format for every message
+    _struct = struct.Struct(bytes_format)
+    _size = _struct.size
+
+    # fixed set of attributes; avoids a per-instance __dict__
+    __slots__ = tuple(__attrs__) + ('_timestampits',)
+
+    # names accessible with __getitem__
+    _item_names = frozenset(__attrs__ + ['timestampits'])
+
+    # returns a tuple of all message fields in a single C-level call
+    _fields_getter = operator.attrgetter(*__attrs__)
+
     def __init__(self, **kwargs):
         '''create a new CAM message.
 
         '''
-        self.__dict__.update(self.unavailable_indicators)
-        self.__dict__.update(kwargs)
-        if not 'message_id' in kwargs:
-            kwargs['message_id'] = 2
-        if not kwargs['message_id'] == 2:
+        if 'message_id' in kwargs and not kwargs['message_id'] == 2:
             raise ValueError('message_id must be 2, but is {}'.format(kwargs['message_id']))
         if 'station_id' not in kwargs:
             raise ValueError('station_id is required, but was not given')
         if 'gen_delta_time_millis' not in kwargs:
             raise ValueError('gen_delta_time_millis is required, but was not given')
+        for field in kwargs:
+            if field not in self.__attrs__:
+                raise ValueError('{} is not a CAM field'.format(field))
 
-        # store the absolute time
-        self.__dict__['timestampits'] = timestampits_from_gdt(
-            kwargs['gen_delta_time_millis'],
-        )
+        self.message_id = 2
+        for field in self.__attrs__[1:]:
+            setattr(self, field, kwargs.get(field, self.unavailable_indicators.get(field)))
         return
 
+    @classmethod
+    def _make(cls, values):
+        '''create a CAM object from a tuple of field values ordered as in
+        __attrs__. bypasses __init__ and the bulk of its validation, so
+        it should only be used for values read off the wire.
+
+        '''
+        if values[0] != 2:
+            raise ValueError('message_id must be 2, but is {}'.format(values[0]))
+        obj = cls.__new__(cls)
+
+        # a single unpacking assignment compiles to one store per slot,
+        # which is much faster than calling setattr in a loop.
+        (
+            obj.message_id,
+            obj.station_id,
+            obj.gen_delta_time_millis,
+            obj.container_mask,
+            obj.station_type,
+            obj.latitude,
+            obj.longitude,
+            obj.semi_major_axis_confidence,
+            obj.semi_minor_axis_confidence,
+            obj.semi_major_orientation,
+            obj.altitude,
+            obj.heading,
+            obj.heading_confidence,
+            obj.speed,
+            obj.speed_confidence,
+            obj.vehicle_length,
+            obj.vehicle_width,
+            obj.longitudinal_acceleration,
+            obj.longitudinal_acceleration_confidence,
+            obj.yaw_rate,
+            obj.yaw_rate_confidence,
+            obj.vehicle_role,
+        ) = values
+        return obj
+
     @classmethod
     def from_bytes(cls, b):
         '''create a CAM object from a byte array b formatted according to the
@@ -145,34 +247,76 @@ class CAM(object):
         '''
         if not isinstance(b, bytes):
             raise TypeError('b must be of type bytes, but is {}'.format(type(b)))
-        values = struct.unpack(cls.bytes_format, b)
-        return cls(
-            **{field: value for field, value in zip(
-                cls.__attrs__,
-                values,
-            )}
-        )
+        return cls._make(cls._struct.unpack(b))
+
+    @classmethod
+    def _from_buffer(cls, buf):
+        '''create a CAM object from a buffer holding a single message, e.g.,
+        a bytearray filled by sock.recv_into.
+
+        '''
+        return cls._make(cls._struct.unpack_from(buf, 0))
 
     def as_bytes(self):
         '''return the bytes representation of the message.'''
-        return struct.pack(
-            self.bytes_format,
-            *[self.__dict__[field] for field in self.__attrs__],
+        return self._struct.pack(
+            self.message_id,
+            self.station_id,
+            self.gen_delta_time_millis,
+            self.container_mask,
+            self.station_type,
+            self.latitude,
+            self.longitude,
+            self.semi_major_axis_confidence,
+            self.semi_minor_axis_confidence,
+            self.semi_major_orientation,
+            self.altitude,
+            self.heading,
+            self.heading_confidence,
+            self.speed,
+            self.speed_confidence,
+            self.vehicle_length,
+            self.vehicle_width,
+            self.longitudinal_acceleration,
+            self.longitudinal_acceleration_confidence,
+            self.yaw_rate,
+            self.yaw_rate_confidence,
+            self.vehicle_role,
         )
 
     def as_dict(self):
         '''return the message as a dict.'''
-        return {field: self.__dict__[field] for field in self.__attrs__}
+        return dict(zip(self.__attrs__, self._fields_getter(self)))
+
+    @property
+    def timestampits(self):
+        '''the absolute time the message was generated as an ITS
+        timestamp. computed from gen_delta_time_millis on first access,
+        which therefore has to happen less than 65536 ms after the
+        message was generated.
+
+        '''
+        try:
+            return self._timestampits
+        except AttributeError:
+            self._timestampits = timestampits_from_gdt(self.gen_delta_time_millis)
+            return self._timestampits
+
+    @timestampits.setter
+    def timestampits(self, timestampits):
+        self._timestampits = timestampits
 
     def age(self, timestampits=None):
         '''return the age of the message in milliseconds.'''
         if timestampits is None:
             timestampits = timestampits_now()
-        return timestampits - self['timestampits']
+        return timestampits - self.timestampits
 
     def __getitem__(self, field):
         '''dict-like access to message fields.'''
-        return self.__dict__[field]
+        if field not in self._item_names:
+            raise KeyError(field)
+        return getattr(self, field)
 
     def __repr__(self):
         return 'CAM' + str(self.as_dict())
@@ -180,13 +324,12 @@ class CAM(object):
     def __eq__(self, other):
         if not isinstance(other, self.__class__):
             return False
-        for field in self.__attrs__:
-            if self.__dict__[field] != other.__dict__[field]:
-                return False
-        return True
+        return self._fields_getter(self) == self._fields_getter(other)
 
     def __hash__(self):
-        return hash(frozenset(self.as_dict().items()))
+        # a CAM is identified by its sender and generation time. both are
+        # wire fields, so equal CAMs always hash equal.
+        return hash((self.station_id, self.gen_delta_time_millis))
 
 class LDM(object):
     '''Local dynamic map. Associates CAM messages with the transmitting
@@ -195,9 +338,48 @@ class LDM(object):
 
     '''
 
-    def __init__(self):
-        '''create a new LMD. just initializes an empty dict.'''
+    # approximate cost of visiting a grid cell relative to scanning one
+    # row, used to choose between the spatial index and a full scan.
+    cell_cost = 5
+
+    def __init__(self, cell_size=10000, shared=None):
+        '''create a new LMD. initializes an empty dict of CAMs along with
+        a struct-of-arrays shadow of the fields used for filtering.
+
+        args:
+
+        cell_size: side length of the cells of the spatial index, in
+        the same unit as the CAM longitude and latitude fields.
+
+        shared: optional SharedLDM created by this process. every CAM
+        stored in the LDM is also written to it, allowing other
+        processes to query the LDM.
+
+        '''
+        if shared is not None and not isinstance(shared, SharedLDM):
+            raise TypeError('shared must be of type SharedLDM, but is {}'.format(type(shared)))
         self.cams = dict()
+        self.cell_size = cell_size
+        self.shared = shared
+
+        # row i holds the latest CAM received from some vehicle along with
+        # its position and timestamp. _idx maps station_id to row.
+        self._cams = list()
+        self._lon = list()
+        self._lat = list()
+        self._ts = list()
+        self._idx = dict()
+
+        # spatial index. uniform grid mapping (x, y) cell coordinates to
+        # the set of station_ids whose latest position is in that cell.
+        self._grid = dict()
+        self._cells = dict()
+
+        # generation counter guarding the rows and the grid. it is odd
+        # while a write is in progress, so readers can take a consistent
+        # snapshot without a lock by retrying if it was odd or changed
+        # while reading (a seqlock). assumes a single writer thread.
+        self._gen = 0
 
     def __getitem__(self, station_id):
         '''dict-like access to the latest CAM received with given
@@ -208,7 +390,102 @@ class LDM(object):
 
     def __setitem__(self, station_id, cam):
         '''associate a CAM message with a station_id'''
+        # read everything that may raise before opening the write, so a
+        # bad CAM can't leave the generation counter odd or the rows out
+        # of step with each other.
+        longitude = cam.longitude
+        latitude = cam.latitude
+        timestampits = cam.timestampits
+        cell = self._cell(longitude, latitude)
+        row = self._idx.get(station_id)
+        if self.shared is not None:
+            shared_values = self.shared._pack(cam)
+
+        # rows are appended before they are indexed, and indexed before
+        # they are added to the grid, so a reader never finds a row that
+        # doesn't exist yet.
+        self._gen += 1
         self.cams[station_id] = cam
+        if row is None:
+            row = len(self._cams)
+            self._cams.append(cam)
+            self._lon.append(longitude)
+            self._lat.append(latitude)
+            self._ts.append(timestampits)
+            self._idx[station_id] = row
+        else:
+            self._cams[row] = cam
+            self._lon[row] = longitude
+            self._lat[row] = latitude
+            self._ts[row] = timestampits
+
+        old_cell = self._cells.get(station_id)
+        if cell != old_cell:
+            if old_cell is not None:
+                old_cell_ids = self._grid[old_cell]
+                old_cell_ids.discard(station_id)
+                if not old_cell_ids:
+                    del self._grid[old_cell]
+            self._grid.setdefault(cell, set()).add(station_id)
+            self._cells[station_id] = cell
+        self._gen += 1
+
+        if self.shared is not None:
+            self.shared._write(row, shared_values)
+
+    def _cell(self, longitude, latitude):
+        '''return the (x, y) coordinates of the grid cell containing the
+        given position.
+
+        '''
+        return (int(longitude // self.cell_size), int(latitude // self.cell_size))
+
+    def _candidate_rows(self, longitude, latitude, max_distance):
+        '''return a list of the rows of vehicles that may be within
+        max_distance of the given position, or None if every row has
+        to be scanned. uses the spatial index when the query covers
+        few cells compared to the number of vehicles.
+
+        '''
+        if max_distance == math.inf:
+            return None
+        x0, y0 = self._cell(longitude - max_distance, latitude - max_distance)
+        x1, y1 = self._cell(longitude + max_distance, latitude + max_distance)
+
+        # visiting a cell costs several times more than scanning a row,
+        # so only use the index when the query covers few cells.
+        if (x1 - x0 + 1) * (y1 - y0 + 1) * self.cell_cost > len(self._cams):
+            return None
+        grid, idx = self._grid, self._idx
+        return [
+            idx[station_id]
+            for x in range(x0, x1 + 1)
+            for y in range(y0, y1 + 1)
+            for station_id in tuple(grid.get((x, y), ()))
+        ]
+
+    def _snapshot(self, longitude, latitude, max_distance):
+        '''return a consistent copy of the rows of vehicles that may be
+        within max_distance of the given position, as a tuple of lists
+        (cams, longitudes, latitudes, timestamps). only the candidate
+        rows are copied unless every row has to be scanned. safe to
+        call concurrently with __setitem__.
+
+        '''
+        columns = (self._cams, self._lon, self._lat, self._ts)
+        while True:
+            gen = self._gen
+            if not gen & 1:
+                rows = self._candidate_rows(longitude, latitude, max_distance)
+                if rows is None:
+                    snapshot = tuple(column[:] for column in columns)
+                else:
+                    snapshot = tuple(
+                        list(map(column.__getitem__, rows)) for column in columns
+                    )
+                if self._gen == gen:
+                    return snapshot
+            time.sleep(0)
 
     def __repr__(self):
         return 'LDM{{nvehicles={}}}'.format(len(self.cams))
@@ -231,24 +508,180 @@ class LDM(object):
         old.
 
         '''
-        if max_distance is None:
-            max_distance = math.inf
-        elif position is None:
-            raise ValueError('position must be given if max_distance is.')
-        if position is None:
-            position = (0.0, 0.0)
-            max_distance = math.inf
-        if max_age is None:
-            max_age = math.inf
-        timestampits = timestampits_now()
-        longitude, latitude = position
-        for station_id, cam in self.cams.items():
-            if cam.age(timestampits=timestampits) > max_age:
-                continue
-            distance = math.sqrt(
-                pow(cam['longitude']-longitude, 2) + pow(cam['latitude'] - latitude, 2)
+        longitude, latitude, max_distance, max_age = _query_args(
+            position, max_distance, max_age,
+        )
+
+        # iterate over a snapshot so that CAMs received while iterating
+        # neither raise nor produce inconsistent results.
+        candidates = zip(*self._snapshot(longitude, latitude, max_distance))
+        yield from _filter_rows(
+            candidates, longitude, latitude, max_distance, max_age,
+        )
+        return
+
+class SharedLDM(object):
+    '''Copy of an LDM in shared memory, allowing other processes to
+    query the latest CAM received from each vehicle without copying
+    the CAM table over a pipe.
+
+    The process owning the LDM creates the shared memory by giving a
+    capacity and passes it to the LDM, which writes every CAM it
+    stores to it. Other processes attach by name. Since vehicles are
+    never removed from an LDM, once capacity distinct vehicles have
+    been seen new ones are no longer shared; a warning is logged the
+    first time this happens.
+
+    Rows are laid out as a struct of arrays (longitude, latitude and
+    timestamp as int64) followed by the packed bytes of each CAM, and
+    are guarded by a generation counter in the header so readers can
+    take a consistent snapshot without a lock (a seqlock).
+
+    '''
+
+    # header fields, each an int64: generation counter, number of rows
+    # written and capacity.
+    _header_size = 3 * 8
+
+    def __init__(self, name=None, capacity=None):
+        '''create a new shared memory block with room for capacity vehicles,
+        or attach to the existing block with the given name if
+        capacity is not given.
+
+        '''
+        if capacity is None:
+            if name is None:
+                raise ValueError('name must be given if capacity is not.')
+            try:
+                self._shm = shared_memory.SharedMemory(name=name, track=False)
+            except TypeError:
+                # before python 3.13, attaching registers the block with
+                # the resource tracker, which would remove it when this
+                # process exits even though another process owns it.
+                self._shm = shared_memory.SharedMemory(name=name)
+                resource_tracker.unregister(self._shm._name, 'shared_memory')
+
+            # the size of the block may have been rounded up to a page,
+            # so the capacity is read from the header.
+            self._header = self._shm.buf[:self._header_size].cast('q')
+            capacity = self._header[2]
+        else:
+            self._shm = shared_memory.SharedMemory(
+                name=name,
+                create=True,
+                size=self._header_size + capacity * (3 * 8 + CAM._size),
             )
-            if distance > max_distance:
-                continue
+            self._header = self._shm.buf[:self._header_size].cast('q')
+            self._header[2] = capacity
+        self.name = self._shm.name
+        self.capacity = capacity
+        self._full = False
+
+        # the header is followed by the arrays and the packed CAMs.
+        buf = self._shm.buf
+        offset = self._header_size
+        self._lon = buf[offset:offset + 8 * capacity].cast('q')
+        offset += 8 * capacity
+        self._lat = buf[offset:offset + 8 * capacity].cast('q')
+        offset += 8 * capacity
+        self._ts = buf[offset:offset + 8 * capacity].cast('q')
+        offset += 8 * capacity
+        self._records = buf[offset:offset + CAM._size * capacity]
+
+    def close(self):
+        '''detach from the shared memory. the block is removed once the
+        creating process calls unlink.
+
+        '''
+        for view in (self._header, self._lon, self._lat, self._ts, self._records):
+            view.release()
+        self._shm.close()
+
+    def unlink(self):
+        '''remove the shared memory block. should only be called by the
+        process that created it.
+
+        '''
+        self._shm.unlink()
+
+    def __repr__(self):
+        return 'SharedLDM{{name={}, nvehicles={}}}'.format(self.name, self._header[1])
+
+    def _pack(self, cam):
+        '''return the values to store for cam as a tuple (longitude,
+        latitude, timestampits, record). raises if cam can't be
+        stored, and is called by the owning LDM before it stores cam so
+        that the LDM and the shared copy can't disagree.
+
+        '''
+        return (
+            operator.index(cam.longitude),
+            operator.index(cam.latitude),
+            operator.index(cam.timestampits),
+            CAM._struct.pack(*CAM._fields_getter(cam)),
+        )
+
+    def _write(self, row, values):
+        '''store values, as returned by _pack, in the given row. called by
+        the owning LDM.
+
+        '''
+        if row >= self.capacity:
+            if not self._full:
+                logging.warning(
+                    'SharedLDM {} is full; vehicles beyond the first {} are not shared.'.format(
+                        self.name, self.capacity,
+                    )
+                )
+                self._full = True
+            return
+        longitude, latitude, timestampits, record = values
+        offset = row * CAM._size
+        header = self._header
+        header[0] += 1
+        self._lon[row] = longitude
+        self._lat[row] = latitude
+        self._ts[row] = timestampits
+        self._records[offset:offset + CAM._size] = record
+        if row >= header[1]:
+            header[1] = row + 1
+        header[0] += 1
+
+    def _snapshot(self):
+        '''return a consistent copy of the rows as a tuple (longitudes,
+        latitudes, timestamps, records).
+
+        '''
+        header = self._header
+        while True:
+            gen = header[0]
+            if not gen & 1:
+                n = header[1]
+                snapshot = (
+                    self._lon[:n].tolist(),
+                    self._lat[:n].tolist(),
+                    self._ts[:n].tolist(),
+                    self._records[:n * CAM._size].tobytes(),
+                )
+                if header[0] == gen:
+                    return snapshot
+            time.sleep(0)
+
+    def iter_cams(self, position=None, max_distance=None, max_age=None):
+        '''return an iterator over the latest CAM received from each
+        vehicle. takes the same arguments as LDM.iter_cams.
+
+        '''
+        longitude, latitude, max_distance, max_age = _query_args(
+            position, max_distance, max_age,
+        )
+        lons, lats, tss, records = self._snapshot()
+        rows = _filter_rows(
+            zip(range(len(tss)), lons, lats, tss),
+            longitude, latitude, max_distance, max_age,
+        )
+        for row in rows:
+            cam = CAM._make(CAM._struct.unpack_from(records, row * CAM._size))
+            cam.timestampits = tss[row]
             yield cam
         return
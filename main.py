@@ -33,6 +33,20 @@ parser.add_argument(
     default='6000',
     help='port to receive local CAMs on.',
 )
+parser.add_argument(
+    '--shared-memory',
+    dest='shared_memory',
+    default=None,
+    help='also share the LDM with other processes under this name.',
+)
+parser.add_argument(
+    '--shared-capacity',
+    dest='shared_capacity',
+    default='4096',
+    help='maximum number of vehicles to share. vehicles are never '
+    'removed from the LDM, so once this many distinct vehicles have been '
+    'seen, new ones are no longer shared.',
+)
 
 def receiver(ldm, port):
     '''listen for local CAM messages and update the LDM accordingly.'''
@@ -41,20 +55,30 @@ def receiver(ldm, port):
     logging.info('Listening for local CAM messages on port {}.'.format(port))
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     sock.bind(('localhost', port))
+    # larger than a CAM so that oversized datagrams are detected
+    # rather than silently truncated.
+    buf = bytearray(256)
     while True:
-        data = sock.recv(256)
-        cam = ldmlib.CAM.from_bytes(data)
-        ldm[cam['station_id']] = cam
-        # logging.info('associated {} with {}'.format(cam, cam['station_id']))
+        n = sock.recv_into(buf)
+        if n != ldmlib.CAM._size:
+            logging.warning('dropping malformed message of {} bytes'.format(n))
+            continue
+        try:
+            cam = ldmlib.CAM._from_buffer(buf)
+        except ValueError as e:
+            logging.warning('dropping malformed message: {}'.format(e))
+            continue
+        ldm[cam.station_id] = cam
     return
 
 def printer(ldm):
     '''periodically print CAM messages.'''
     while True:
         time.sleep(2)
+        timestampits = ldmlib.timestampits_now()
         for cam in ldm.iter_cams():
-            station_id = cam['station_id']
-            age = cam.age()
+            station_id = cam.station_id
+            age = timestampits - cam.timestampits
             logging.info('station_id={}, age={}ms : {}'.format(station_id, age, cam))
 
     return
@@ -62,17 +86,34 @@ def printer(ldm):
 def main():
     args = parser.parse_args()
     port = int(args.port)
-    ldm = ldmlib.LDM()
+    shared = None
+    if args.shared_memory is not None:
+        shared = ldmlib.SharedLDM(
+            name=args.shared_memory,
+            capacity=int(args.shared_capacity),
+        )
+        logging.info('Sharing the LDM as {}.'.format(shared.name))
+    ldm = ldmlib.LDM(shared=shared)
     receiver_thread = threading.Thread(
         target=functools.partial(receiver, ldm, port),
+        daemon=True,
     )
     receiver_thread.start()
 
     printer_thread = threading.Thread(
         target=functools.partial(printer, ldm),
+        daemon=True,
     )
     printer_thread.start()
 
+    try:
+        receiver_thread.join()
+    finally:
+        # the receiver thread may still be writing to the shared memory,
+        # so only remove its name. the mapping is released on exit.
+        if shared is not None:
+            shared.unlink()
+
 if __name__ == '__main__':
     logging.basicConfig(level=logging.INFO)
     main()
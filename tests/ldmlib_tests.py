@@ -1,4 +1,7 @@
+import os
+import sys
 import unittest
+import subprocess
 import ldmlib
 
 class Tests(unittest.TestCase):
@@ -13,3 +16,237 @@ class Tests(unittest.TestCase):
         self.assertEqual(m_from_dct, m_from_bytes)
         self.assertEqual(b, m_from_bytes.as_bytes())
         return
+
+    def test_from_buffer(self):
+        '''test parsing a CAM from a preallocated buffer.'''
+        dct = {field: i for i, field in enumerate(ldmlib.CAM.__attrs__)}
+        dct['message_id'] = 2
+        m = ldmlib.CAM(**dct)
+        buf = bytearray(256)
+        b = m.as_bytes()
+        buf[:len(b)] = b
+        self.assertEqual(m, ldmlib.CAM._from_buffer(buf))
+        return
+
+    def test_unavailable_fields(self):
+        '''test that omitted fields are marked as unavailable.'''
+        m = ldmlib.CAM(station_id=1, gen_delta_time_millis=2)
+        self.assertEqual(m['message_id'], 2)
+        self.assertEqual(m['latitude'], ldmlib.CAM.unavailable_indicators['latitude'])
+        self.assertEqual(m, ldmlib.CAM.from_bytes(m.as_bytes()))
+        self.assertRaises(KeyError, m.__getitem__, 'age')
+        self.assertRaises(ValueError, ldmlib.CAM, station_id=1, gen_delta_time_millis=2, foo=3)
+        return
+
+    def test_lazy_timestampits(self):
+        '''test that timestampits is computed on first access.'''
+        gdt = ldmlib.gdt_now(None)
+        m = ldmlib.CAM.from_bytes(
+            ldmlib.CAM(station_id=1, gen_delta_time_millis=gdt).as_bytes(),
+        )
+        self.assertFalse(hasattr(m, '_timestampits'))
+        timestampits = m.timestampits
+        self.assertEqual(timestampits, ldmlib.timestampits_from_gdt(gdt))
+        self.assertEqual(m._timestampits, timestampits)
+        self.assertEqual(m['timestampits'], timestampits)
+        m.timestampits = timestampits - 5000
+        self.assertEqual(m.timestampits, timestampits - 5000)
+        self.assertGreaterEqual(m.age(), 5000)
+        return
+
+    def test_iter_cams(self):
+        '''test filtering the LDM by distance and age.'''
+        for cell_size, cell_cost in [(1, 0), (4, 0), (10000, 0), (10000, 5)]:
+            ldm = ldmlib.LDM(cell_size=cell_size)
+            ldm.cell_cost = cell_cost
+            for station_id, (lon, lat) in enumerate([(0, 0), (3, 4), (30, 40)]):
+                ldm[station_id] = ldmlib.CAM(
+                    station_id=station_id,
+                    gen_delta_time_millis=ldmlib.gdt_now(None),
+                    longitude=lon,
+                    latitude=lat,
+                )
+            ldm[1] = ldmlib.CAM(
+                station_id=1,
+                gen_delta_time_millis=ldmlib.gdt_now(None),
+                longitude=6,
+                latitude=8,
+            )
+            self.assertEqual(len(list(ldm.iter_cams())), 3)
+            self.assertEqual(len(list(ldm.iter_cams(max_age=1000))), 3)
+            self.assertEqual(len(ldm._grid), len(set(ldm._cells.values())))
+            near = ldm.iter_cams(position=(0, 0), max_distance=10)
+            self.assertEqual(sorted(cam['station_id'] for cam in near), [0, 1])
+            near = ldm.iter_cams(position=(0, 0), max_distance=9.9)
+            self.assertEqual([cam['station_id'] for cam in near], [0])
+            near = ldm.iter_cams(position=(3, 4), max_distance=1)
+            self.assertEqual(list(near), [])
+            self.assertRaises(ValueError, list, ldm.iter_cams(max_distance=1))
+
+            cam = ldmlib.CAM(
+                station_id=3,
+                gen_delta_time_millis=ldmlib.gdt_now(None),
+                longitude=1,
+                latitude=1,
+            )
+            cam.timestampits -= 5000
+            ldm[3] = cam
+            self.assertEqual(len(list(ldm.iter_cams())), 4)
+            recent = ldm.iter_cams(max_age=1000)
+            self.assertEqual(sorted(cam['station_id'] for cam in recent), [0, 1, 2])
+            near = ldm.iter_cams(position=(0, 0), max_distance=10, max_age=1000)
+            self.assertEqual(sorted(cam['station_id'] for cam in near), [0, 1])
+            old = ldm.iter_cams(max_age=10000)
+            self.assertEqual(len(list(old)), 4)
+        return
+
+    def test_float_cell_size(self):
+        '''test that the spatial index agrees with a full scan when the
+        cell size is not an integer.
+
+        '''
+        ldm = ldmlib.LDM(cell_size=0.1)
+        ldm.cell_cost = 0
+        for station_id in range(6):
+            ldm[station_id] = ldmlib.CAM(
+                station_id=station_id,
+                gen_delta_time_millis=ldmlib.gdt_now(None),
+                longitude=1,
+                latitude=1,
+            )
+        near = ldm.iter_cams(position=(1, 1), max_distance=0)
+        self.assertEqual(len(list(near)), 6)
+        return
+
+    def test_iter_cams_snapshot(self):
+        '''test that updating the LDM while iterating over it is safe.'''
+        ldm = ldmlib.LDM()
+        for station_id in range(10):
+            ldm[station_id] = ldmlib.CAM(
+                station_id=station_id,
+                gen_delta_time_millis=ldmlib.gdt_now(None),
+            )
+        n = 0
+        for cam in ldm.iter_cams():
+            ldm[cam['station_id'] + 10] = ldmlib.CAM(
+                station_id=cam['station_id'] + 10,
+                gen_delta_time_millis=ldmlib.gdt_now(None),
+            )
+            n += 1
+        self.assertEqual(n, 10)
+        self.assertEqual(len(list(ldm.iter_cams())), 20)
+        return
+
+    def test_move_during_query(self):
+        '''test that a vehicle moving while the spatial index is read is
+        returned exactly once, at its new position.
+
+        '''
+        ldm = ldmlib.LDM(cell_size=20)
+        ldm.cell_cost = 0
+        for station_id, position in enumerate([(0, 0), (-10, -10)] + [(1000, 1000)] * 8):
+            ldm[station_id] = ldmlib.CAM(
+                station_id=station_id,
+                gen_delta_time_millis=ldmlib.gdt_now(None),
+                longitude=position[0],
+                latitude=position[1],
+            )
+        moved = ldmlib.CAM(
+            station_id=1,
+            gen_delta_time_millis=ldmlib.gdt_now(None),
+            longitude=10,
+            latitude=10,
+        )
+
+        # move vehicle 1 from the first cell visited to a later one,
+        # as if the receiver thread ran in the middle of the walk.
+        class Grid(dict):
+            ncalls = 0
+            def get(self, cell, default=None):
+                Grid.ncalls += 1
+                if Grid.ncalls == 2:
+                    ldm[1] = moved
+                return dict.get(self, cell, default)
+        ldm._grid = Grid(ldm._grid)
+
+        near = list(ldm.iter_cams(position=(0, 0), max_distance=20))
+        self.assertGreater(Grid.ncalls, 2)
+        self.assertEqual(sorted(cam['station_id'] for cam in near), [0, 1])
+        self.assertIn(moved, near)
+        return
+
+    def test_failed_insert(self):
+        '''test that a failed insert doesn't block or corrupt the LDM.'''
+        ldm = ldmlib.LDM()
+        cam = ldmlib.CAM(station_id=1, gen_delta_time_millis=ldmlib.gdt_now(None))
+        self.assertRaises(AttributeError, ldm.__setitem__, 1, object())
+        self.assertRaises(TypeError, ldm.__setitem__, [1], cam)
+        self.assertEqual(list(ldm.iter_cams()), [])
+        self.assertEqual(len(ldm._cams), len(ldm._lon))
+        ldm[1] = cam
+        self.assertEqual(list(ldm.iter_cams()), [cam])
+        return
+
+    def test_shared_ldm(self):
+        '''test querying an LDM through shared memory.'''
+        shared = ldmlib.SharedLDM(capacity=2)
+        try:
+            ldm = ldmlib.LDM(shared=shared)
+            cams = [
+                ldmlib.CAM(
+                    station_id=station_id,
+                    gen_delta_time_millis=ldmlib.gdt_now(None),
+                    longitude=station_id,
+                    latitude=station_id,
+                )
+                for station_id in range(4)
+            ]
+            with self.assertLogs(level='WARNING') as logs:
+                for cam in cams:
+                    ldm[cam['station_id']] = cam
+            self.assertEqual(len(logs.output), 1)
+            self.assertIn('is full', logs.output[0])
+            self.assertEqual(list(shared.iter_cams()), cams[:2])
+            near = shared.iter_cams(position=(1, 1), max_distance=0.5)
+            self.assertEqual(list(near), cams[1:2])
+
+            # a CAM that can't be shared is rejected before either copy
+            # is changed, and doesn't block readers.
+            bad = ldmlib.CAM(
+                station_id=1,
+                gen_delta_time_millis=ldmlib.gdt_now(None),
+                longitude=1.5,
+            )
+            self.assertRaises(TypeError, ldm.__setitem__, 1, bad)
+            self.assertEqual(ldm[1], cams[1])
+            self.assertEqual(list(shared.iter_cams()), cams[:2])
+
+            # attach from another process
+            script = (
+                'import ldmlib\n'
+                'view = ldmlib.SharedLDM(name={!r})\n'
+                'print(view.capacity, [cam["station_id"] for cam in view.iter_cams()])\n'
+                'view.close()\n'
+            ).format(shared.name)
+            result = subprocess.run(
+                [sys.executable, '-c', script],
+                cwd=os.path.dirname(os.path.abspath(ldmlib.__file__)),
+                capture_output=True,
+                text=True,
+                timeout=30,
+            )
+            self.assertEqual(result.returncode, 0, result.stderr)
+            self.assertEqual(result.stdout, '2 [0, 1]\n')
+            self.assertEqual(result.stderr, '')
+        finally:
+            shared.close()
+            shared.unlink()
+        return
+
+    def test_byte_order(self):
+        '''test that CAMs are packed in network (big-endian) byte order.'''
+        m = ldmlib.CAM(station_id=0x01020304, gen_delta_time_millis=0x0506)
+        b = m.as_bytes()
+        self.assertEqual(len(b), ldmlib.CAM._size)
+        self.assertEqual(b[:9], bytes([2, 1, 2, 3, 4, 0, 0, 5, 6]))
+        return